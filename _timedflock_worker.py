@@ -0,0 +1,133 @@
+# The child side of timedflock.py and timedflock2.py: the lock daemon and the
+# worker which holds a file lock. It is run as `python -I -S` and kept free of
+# anything but the modules it needs.
+import sys
+import os
+import math
+import fcntl
+import signal
+import socket
+import struct
+import threading
+from array import array
+from select import poll, POLLIN
+
+# must match timedflock.py and timedflock2.py
+_DAEMON_ARG = '--daemon'
+_CONFIG_FORMAT = '<Bd'
+_CONFIG_SIZE = struct.calcsize(_CONFIG_FORMAT)
+_LOCKED = b'L'
+
+# flock operation by (shared, non-blocking)
+_LOCK_OPS = {
+    (False, False): fcntl.LOCK_EX,
+    (False, True): fcntl.LOCK_EX | fcntl.LOCK_NB,
+    (True, False): fcntl.LOCK_SH,
+    (True, True): fcntl.LOCK_SH | fcntl.LOCK_NB,
+}
+
+# larger than any message from the parent
+_MAX_MESSAGE = 64
+
+def _read_more(fd, data, size):
+    # a SOCK_SEQPACKET message is read whole, a stream may come in pieces
+    while len(data) < size:
+        chunk = os.read(fd, _MAX_MESSAGE)
+        if not chunk:
+            raise EOFError('parent process exited')
+        data += chunk
+    return data
+
+def _read_config(fd):
+    data = _read_more(fd, b'', _CONFIG_SIZE)
+    shared, timeout = struct.unpack_from(_CONFIG_FORMAT, data)
+    return {
+        'shared': bool(shared),
+        'timeout': timeout if timeout >= 0 else None,
+    }
+
+def _wait_readable(fds, timeout=None):
+    # not select(), a worker started by Popen inherits the fd numbers of its
+    # parent, which may be over FD_SETSIZE
+    poller = poll()
+    for fd in fds:
+        poller.register(fd, POLLIN)
+    if timeout is not None:
+        timeout = int(math.ceil(timeout * 1000))
+    return [fd for fd, _event in poller.poll(timeout)]
+
+def _flock(conn_fd, lock_fd, shared, timeout):
+    try:
+        fcntl.flock(lock_fd, _LOCK_OPS[shared, True])
+        return True
+    except (IOError, OSError):
+        if timeout == 0:
+            return False
+
+    # flock in a helper thread while the main thread watches the connection.
+    # On timeout or if the parent goes away the worker just exits, which
+    # cancels the pending flock in the kernel.
+    result = []
+    done_r, done_w = os.pipe()
+
+    def _target():
+        try:
+            fcntl.flock(lock_fd, _LOCK_OPS[shared, False])
+            result.append(True)
+        except (IOError, OSError):
+            result.append(False)
+        os.write(done_w, b'x')
+
+    thread = threading.Thread(target=_target)
+    thread.daemon = True
+    thread.start()
+    return done_r in _wait_readable([conn_fd, done_r], timeout) and result[0]
+
+def _daemon():
+    # posix_spawn does not close the inheritable fds of the parent
+    os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+
+    # workers are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0,
+                         sys.stdin.fileno())
+    fd_size = array('i').itemsize
+
+    while True:
+        request, ancdata, _flags, _addr = sock.recvmsg(
+            1, socket.CMSG_SPACE(3 * fd_size))
+        if not request:
+            break  # parent process exited
+
+        fds = array('i')
+        fds.frombytes(ancdata[0][2][:3 * fd_size])
+        conn_fd, wakeup_fd, lock_fd = fds
+
+        if os.fork() == 0:
+            try:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                _worker(conn_fd, wakeup_fd, lock_fd)
+            finally:
+                os._exit(0)
+
+        for fd in fds:
+            os.close(fd)
+
+def _worker(conn_fd, wakeup_fd, lock_fd):
+    # load config, the lock file is opened by the parent
+    config = _read_config(conn_fd)
+
+    if _flock(conn_fd, lock_fd, config['shared'], config['timeout']):
+        os.write(conn_fd, _LOCKED)
+        # block until the parent releases the lock or goes away, the parent
+        # sends nothing else so a readable connection means EOF
+        _wait_readable([conn_fd, wakeup_fd])
+
+if __name__ == '__main__':
+    if sys.argv[1] == _DAEMON_ARG:
+        _daemon()
+    else:
+        _worker(*[int(arg) for arg in sys.argv[1:4]])
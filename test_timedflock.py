@@ -0,0 +1,229 @@
+"""
+Tests of the in-process fast path and the worker protocol of `timedflock`
+and `timedflock2`.
+"""
+import sys
+import os
+import time
+import signal
+import resource
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+
+import timedflock
+import timedflock2
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# takes a lock in another process and holds it until stdin is closed
+_HOLDER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+module = __import__(sys.argv[2])
+with module.TimedFileLock(sys.argv[3], shared=sys.argv[4] == '1') as lck:
+    sys.stdout.write('locked\\n' if lck.locked() else 'failed\\n')
+    sys.stdout.flush()
+    sys.stdin.read()
+"""
+
+class _TimedFileLockTests(object):
+    module = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lockfile = os.path.join(self.tmpdir, 'lock')
+        self.holders = []
+
+    def tearDown(self):
+        for holder in self.holders:
+            self._release_holder(holder)
+        shutil.rmtree(self.tmpdir)
+
+    def _lock(self, **kwargs):
+        return self.module.TimedFileLock(self.lockfile, **kwargs)
+
+    def _hold(self, shared=False, reply=b'locked\n'):
+        holder = subprocess.Popen(
+            [sys.executable, '-c', _HOLDER, _HERE, self.module.__name__,
+             self.lockfile, '1' if shared else '0'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.holders.append(holder)
+        self.assertEqual(holder.stdout.readline(), reply)
+        return holder
+
+    def _release_holder(self, holder):
+        if holder.returncode is None:
+            holder.stdin.close()
+            holder.stdout.close()
+            holder.wait()
+
+    def test_uncontended(self):
+        for shared in (False, True):
+            for timeout in (0, 1, None):
+                with self._lock(shared=shared, timeout=timeout) as lck:
+                    self.assertTrue(lck.locked())
+                self.assertFalse(lck.locked())
+
+    def test_in_process(self):
+        with self._lock(shared=True) as first:
+            with self._lock(shared=True) as second:
+                self.assertTrue(first.locked())
+                self.assertTrue(second.locked())
+            with self._lock() as exclusive:
+                self.assertFalse(exclusive.locked())
+
+        with self._lock() as first:
+            with self._lock(shared=True) as second:
+                self.assertFalse(second.locked())
+            start = time.time()
+            with self._lock(timeout=0.2) as second:
+                self.assertFalse(second.locked())
+            self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_in_process_threads(self):
+        with self._lock() as first:
+            result = []
+
+            def _target():
+                with self._lock(timeout=5) as second:
+                    result.append(second.locked())
+
+            thread = threading.Thread(target=_target)
+            thread.start()
+            time.sleep(0.1)
+        thread.join()
+        self.assertEqual(result, [True])
+
+    def test_contended(self):
+        holder = self._hold()
+        for shared in (False, True):
+            with self._lock(shared=shared) as lck:
+                self.assertFalse(lck.locked())
+
+        start = time.time()
+        with self._lock(timeout=0.5) as lck:
+            self.assertFalse(lck.locked())
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+        # the worker takes the lock once the holder has released it
+        timer = threading.Timer(0.2, self._release_holder, (holder,))
+        timer.start()
+        try:
+            with self._lock(timeout=5) as lck:
+                self.assertTrue(lck.locked())
+        finally:
+            timer.join()
+
+    def test_contended_shared(self):
+        self._hold(shared=True)
+        with self._lock(shared=True) as lck:
+            self.assertTrue(lck.locked())
+        with self._lock(timeout=0.2) as lck:
+            self.assertFalse(lck.locked())
+
+    def test_worker_release(self):
+        holder = self._hold()
+        timer = threading.Timer(0.2, self._release_holder, (holder,))
+        timer.start()
+        try:
+            with self._lock(timeout=5) as lck:
+                self.assertTrue(lck.locked())
+                # held by the worker now
+                self._hold(reply=b'failed\n')
+        finally:
+            timer.join()
+        self._release_holder(self._hold())
+
+    def test_daemon_reaped_elsewhere(self):
+        daemon = self.module._LockDaemon.get()
+        if daemon is None:
+            self.skipTest('no lock daemon')
+        os.kill(daemon._proc.pid, signal.SIGKILL)
+        os.waitpid(daemon._proc.pid, 0)
+
+        holder = self._hold()
+        timer = threading.Timer(0.2, self._release_holder, (holder,))
+        timer.start()
+        try:
+            with self._lock(timeout=5) as lck:
+                self.assertTrue(lck.locked())
+        finally:
+            timer.join()
+        self.assertIsNot(self.module._LockDaemon.get(), daemon)
+
+    def test_many_fds(self):
+        # select() cannot take fds over FD_SETSIZE (1024)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < 2048:
+            self.skipTest('RLIMIT_NOFILE too low')
+        if soft != resource.RLIM_INFINITY and soft < 2048:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (2048, hard))
+        fds = []
+        try:
+            while len(fds) < 1100:
+                fds.append(os.open(os.devnull, os.O_RDONLY))
+
+            holder = self._hold()
+            timer = threading.Timer(0.2, self._release_holder, (holder,))
+            timer.start()
+            try:
+                with self._lock(timeout=5) as lck:
+                    self.assertTrue(lck.locked())
+            finally:
+                timer.join()
+            self._release_holder(self._hold())
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_bad_path(self):
+        lockfile = os.path.join(self.tmpdir, 'missing', 'lock')
+        for timeout in (0, 0.1, None):
+            with self.module.TimedFileLock(lockfile, timeout=timeout) as lck:
+                self.assertFalse(lck.locked())
+
+    def test_release_with_forked_child(self):
+        with self._lock():
+            pid = os.fork()
+            if pid == 0:
+                time.sleep(1)
+                os._exit(0)
+        try:
+            self._release_holder(self._hold())
+        finally:
+            os.waitpid(pid, 0)
+
+    def test_forked_child_keeps_parent_lock(self):
+        with self._lock() as lck:
+            pid = os.fork()
+            if pid == 0:
+                lck._unlock()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self._hold(reply=b'failed\n')
+
+    def test_state_dropped(self):
+        with self._lock():
+            with self._lock():
+                pass
+        with self.module.TimedFileLock(os.path.join(self.tmpdir, 'x', 'y')):
+            pass
+        self.assertFalse(self.module._PathLock._instances)
+
+    def test_tag(self):
+        self.assertEqual(self._lock(tag=1).tag, '1')
+        lck = self.module.TimedFileLock(self.lockfile)
+        self.assertTrue(lck.tag.startswith('test_tag@test_timedflock.py:'))
+
+class TimedFileLockTest(_TimedFileLockTests, unittest.TestCase):
+    module = timedflock
+
+class TimedFileLock2Test(_TimedFileLockTests, unittest.TestCase):
+    module = timedflock2
+
+if __name__ == '__main__':
+    unittest.main()
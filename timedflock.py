@@ -5,10 +5,13 @@ timedflock
 `timedflock` module provides a file lock class `TimedFileLock` on Unix-like
 platforms which uses `fcntl.flock` at its core and supports timeout.
 
-`TimedFileLock` does not poll the file lock to support timeout. Instead, it
-spawns a child process to do `fcntl.flock`. Because of this, the main process
-does not actually hold the file lock. This means that `TimedFileLock` is not
-re-entrant and behaves more like `threading.Lock`.
+`TimedFileLock` does not poll the file lock to support timeout. If no other
+process holds the lock, it is taken directly by a non-blocking `fcntl.flock`
+and the threads of the current process wait for each other in process.
+Otherwise it lets a child process do the blocking `fcntl.flock`. The children
+are forked by a helper daemon which is started on first use, so only the first
+contended lock request pays for the interpreter startup. `TimedFileLock` is
+not re-entrant and behaves more like `threading.Lock`.
 
 `TimedFileLock` supports both shared lock and exclusive lock. It can be used
 as reader-writer lock.
@@ -27,27 +30,62 @@ with TimedFileLock(lockfile, shared=False, timeout=5.5) as _lck:
 ```
 
 """
-from __future__ import print_function
-
 import sys
 import os
+import errno
 import fcntl
 import signal
 import time
-import json
+import socket
+import struct
 import threading
-import traceback
-from subprocess import Popen, PIPE
-
-try:
-    from thread import get_ident
-except ImportError:
-    from _thread import get_ident
+from array import array
+from subprocess import Popen
 
 __all__ = ['TimedFileLock']
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
 _PY_EXEC = sys.executable
-_PY_FILE = os.path.realpath(__file__)
+_WORKER_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '_timedflock_worker.py')
+_worker_script_path = None
+
+# skip site.py and the environment, the worker only needs the stdlib
+if sys.version_info >= (3, 4):
+    _PY_FLAGS = ['-I', '-S', '-B', '-u']
+else:
+    _PY_FLAGS = ['-E', '-s', '-S', '-B', '-u']
+
+# must match _timedflock_worker.py
+_DAEMON_ARG = '--daemon'
+
+# lock config sent to the worker: shared, timeout
+_CONFIG_FORMAT = '<Bd'
+
+# reply of the worker once it holds the lock
+_LOCKED = b'L'
+
+# the worker blocks on an eventfd (or a pipe) until the lock is released
+_HAS_EVENTFD = hasattr(os, 'eventfd')
+_WAKEUP = struct.pack('=Q', 1)
+
+# flock operation by (shared, non-blocking)
+_LOCK_OPS = {
+    (False, False): fcntl.LOCK_EX,
+    (False, True): fcntl.LOCK_EX | fcntl.LOCK_NB,
+    (True, False): fcntl.LOCK_SH,
+    (True, True): fcntl.LOCK_SH | fcntl.LOCK_NB,
+}
+
+# os.waitstatus_to_exitcode came in Python 3.9, a year after posix_spawn
+_HAS_POSIX_SPAWN = (hasattr(os, 'posix_spawn') and
+                    hasattr(os, 'waitstatus_to_exitcode'))
+
+# the daemon passes sockets with SCM_RIGHTS, which needs Python 3.3+
+_DAEMON_SUPPORTED = (hasattr(socket, 'SOCK_SEQPACKET') and
+                     hasattr(socket, 'SCM_RIGHTS') and
+                     hasattr(socket.socket, 'sendmsg'))
 
 class TimedFileLock:
     """
@@ -81,19 +119,43 @@ class TimedFileLock:
             if timeout < 0:
                 raise ValueError("Invalid timeout")
 
+        # abspath calls getcwd, only a relative path needs it
+        if os.path.isabs(lockfile):
+            lockfile = os.path.normpath(lockfile)
+        else:
+            lockfile = os.path.abspath(lockfile)
+
         self._config = {
-            'lockfile': os.path.abspath(lockfile),
+            'lockfile': lockfile,
             'shared': bool(shared),
             'timeout': timeout,
         }
 
         if tag is not None:
-            self.tag = str(tag)
+            self._tag = str(tag)
+            self._caller = None
         else:
-            _file, _no, _func, _text = traceback.extract_stack(limit=2)[0]
-            self.tag = '{}@{}:{}'.format(_func, os.path.basename(_file), _no)
+            # remember the caller only, the tag is formatted when it is read
+            frame = sys._getframe(1)
+            self._tag = None
+            self._caller = (frame.f_code.co_name, frame.f_code.co_filename,
+                            frame.f_lineno)
 
+        self._path_lock = None
         self._subproc = None
+        self._wakeup = None
+
+    @property
+    def tag(self):
+        """The string to identify the lock."""
+        if self._tag is None:
+            _func, _file, _no = self._caller
+            self._tag = '{}@{}:{}'.format(_func, os.path.basename(_file), _no)
+        return self._tag
+
+    @tag.setter
+    def tag(self, tag):
+        self._tag = str(tag)
 
     def __enter__(self):
         self._try_lock()
@@ -104,17 +166,38 @@ class TimedFileLock:
         return None
 
     def _try_lock(self):
-        parent = 'ppid:{},tid:{}'.format(os.getpid(), get_ident())
-        config = json.dumps(self._config)
+        lockfile = self._config['lockfile']
+        shared = self._config['shared']
 
-        proc = None
+        # fast path: nobody else holds the lock
+        path_lock = _PathLock.get(lockfile)
         try:
-            proc = Popen([_PY_EXEC, '-u', _PY_FILE, self.tag, parent, config],
-                         stdin=PIPE,
-                         stdout=PIPE)
+            locked, timeout, lock_file = path_lock.acquire(
+                shared, self._config['timeout'])
+        except (IOError, OSError):
+            return None  # the lock file cannot be opened
+        if locked:
+            self._path_lock = path_lock
+            return None
 
-            outline = proc.stdout.readline()
-            if outline != b'locked\n':
+        if timeout == 0:
+            # the non-blocking flock has failed already, no worker can do
+            # better than that
+            if lock_file is not None:
+                lock_file.close()
+            return None
+
+        proc = None
+        wakeup = _new_wakeup()
+        try:
+            try:
+                proc = _Worker(wakeup[0], lock_file.fileno())
+            finally:
+                lock_file.close()  # the worker has its own fd now
+            proc.send(_pack_config(shared, timeout))
+
+            reply = proc.recv()
+            if reply != _LOCKED:
                 # not locked
                 proc.wait()
                 proc = None
@@ -124,72 +207,351 @@ class TimedFileLock:
                 proc.kill()
             proc = None
 
+        if proc is None:
+            _close_wakeup(wakeup)
+            wakeup = None
+
         self._subproc = proc
+        self._wakeup = wakeup
         return None
 
     def _unlock(self):
+        if self._path_lock is not None:
+            self._path_lock.release()
+            self._path_lock = None
+
         if self._subproc is not None and self._subproc.poll() is None:
-            self._subproc.send_signal(signal.SIGINT)
+            os.write(self._wakeup[1], _WAKEUP)
             self._subproc.wait()
 
+        if self._wakeup is not None:
+            _close_wakeup(self._wakeup)
+
         self._subproc = None
+        self._wakeup = None
         return None
 
     def locked(self):
         """Returns True if the file is locked."""
-        return self._subproc is not None
-
-def _watcher():
-    sys.stdin.read()
-    print('parent process exited', file=sys.stderr)
-    os._exit(1)
-
-def _handler(signum, frame):
-    # signal handler
-    print('received signal:', signum, file=sys.stderr)
-    if signum == signal.SIGINT:
-        sys.exit(0)
-
-if __name__ == '__main__':
-    # set signal handler
-    signal.signal(signal.SIGALRM, _handler)
-    signal.signal(signal.SIGINT, _handler)
-
-    # debug: print tag
-    tag = sys.argv[1]
-    parent = sys.argv[2]
-    print('Created subprocess for lock', tag, 'by', parent, file=sys.stderr)
-
-    # load config
-    config = json.loads(sys.argv[3])
-
-    # watch stdin in case parent process exits
-    watcher = threading.Thread(target=_watcher)
-    watcher.daemon = True
-    watcher.start()
-
-    with open(config['lockfile'], 'ab') as _file:
-        lock_fd = _file.fileno()
-        lock_op = fcntl.LOCK_SH if config['shared'] else fcntl.LOCK_EX
-
-        timeout = config['timeout']
-        if timeout is not None:
-            if timeout > 0:
-                signal.setitimer(signal.ITIMER_REAL, timeout, 1)
-            else:
-                lock_op |= fcntl.LOCK_NB  # non-blocking
+        return self._path_lock is not None or self._subproc is not None
+
+class _PathLock(object):
+    """
+    The in-process state of a lock file. While no other process holds the
+    file lock, the current process takes it with a non-blocking `flock` on a
+    guardian fd, and its threads share it like a reader-writer lock.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    _instances_pid = None
+
+    def __init__(self, lockfile):
+        self._lockfile = lockfile
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._file = None
+        self._shared = False
+        self._holders = 0
+        self._refs = 0  # the threads holding or trying to take the lock
+
+    @classmethod
+    def get(cls, lockfile):
+        """
+        Returns the state of the lock file in the current process. It must be
+        followed by `acquire`, and by `release` if the lock is taken.
+        """
+        with cls._instances_lock:
+            if cls._instances_pid != os.getpid():
+                # locks taken before fork belong to the parent process
+                cls._instances = {}
+                cls._instances_pid = os.getpid()
+
+            path_lock = cls._instances.get(lockfile)
+            if path_lock is None:
+                path_lock = cls._instances[lockfile] = cls(lockfile)
+            path_lock._refs += 1
+            return path_lock
+
+    def _put(self):
+        # forgets the lock file once nobody holds or waits for it
+        cls = type(self)
+        with cls._instances_lock:
+            self._refs -= 1
+            if not self._refs and cls._instances.get(self._lockfile) is self:
+                del cls._instances[self._lockfile]
+
+    def acquire(self, shared, timeout):
+        """
+        Tries to take the lock in process. Returns a tuple (locked, timeout,
+        file) where timeout is what remains for a worker to wait for the lock,
+        and file is the lock file opened for a failed attempt, if any, which
+        the worker can lock instead of opening the file again. Raises
+        `IOError` or `OSError` if the lock file cannot be opened.
+        """
+        try:
+            result = self._acquire(shared, timeout)
+        except:
+            self._put()
+            raise
+        if not result[0]:
+            self._put()
+        return result
+
+    def _acquire(self, shared, timeout):
+        deadline = None if timeout is None else _monotonic() + timeout
+
+        with self._cond:
+            while self._holders and not (shared and self._shared):
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return False, 0.0, None
+                self._cond.wait(remaining)
+
+            if not self._holders:
+                lock_file = self._flock(shared)
+                if lock_file is not None:
+                    if deadline is None:
+                        return False, None, lock_file
+                    return False, max(deadline - _monotonic(), 0.0), lock_file
+                self._shared = shared
+
+            self._holders += 1
+            return True, timeout, None
+
+    def release(self):
+        with self._cond:
+            self._holders -= 1
+            if not self._holders:
+                # a child forked meanwhile shares the open file description,
+                # closing our fd alone would not release the file lock. Only
+                # the process which took the lock may release it though.
+                if self._pid == os.getpid():
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+                self._cond.notify_all()
+        self._put()
+
+    def _flock(self, shared):
+        # returns the opened lock file if it is locked by someone else
+        lock_file = open(self._lockfile, 'ab')
+        try:
+            fcntl.flock(lock_file.fileno(), _LOCK_OPS[shared, True])
+        except (IOError, OSError):
+            return lock_file
+        self._file = lock_file
+        return None
 
-        locked = True
+class _LockDaemon(object):
+    """
+    A long-lived child process which forks a worker for every lock request.
+    One daemon is started lazily per process and shared by all threads.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._sock, peer = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_SEQPACKET)
         try:
-            fcntl.flock(lock_fd, lock_op)
+            # the daemon reads requests from its stdin
+            args = [_PY_EXEC] + _PY_FLAGS + [_worker_script(), _DAEMON_ARG]
+            if _HAS_POSIX_SPAWN:
+                self._proc = _SpawnedProcess(args, stdin=peer.fileno())
+            else:
+                self._proc = Popen(args, stdin=peer.fileno())
         except:
-            locked = False
+            self._sock.close()
+            raise
+        finally:
+            peer.close()
+
+    @classmethod
+    def get(cls):
+        """Returns the daemon of the current process, or None."""
+        if not _DAEMON_SUPPORTED:
+            return None
+
+        with cls._instance_lock:
+            daemon = cls._instance
+            if (daemon is None or daemon._pid != os.getpid() or
+                    daemon._proc.poll() is not None):
+                if daemon is not None:
+                    daemon._sock.close()
+                try:
+                    daemon = cls._instance = cls()
+                except (OSError, ValueError):
+                    daemon = None
+            return daemon
+
+    def spawn(self, conn_fd, wakeup_fd, lock_fd):
+        """Forks a worker in the daemon."""
+        fds = array('i', [conn_fd, wakeup_fd, lock_fd])
+        self._sock.sendmsg([b'F'],
+                           [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+class _SpawnedProcess(object):
+    """
+    A child process started by `os.posix_spawn`, which does not copy the page
+    tables of the parent like `fork` does. It provides the subset of the
+    `Popen` interface used by `_LockDaemon`.
+    """
 
-        # reset timer
-        signal.setitimer(signal.ITIMER_REAL, 0)
+    def __init__(self, args, stdin):
+        self.returncode = None
+        self.pid = os.posix_spawn(args[0], args, os.environ, file_actions=[
+            (os.POSIX_SPAWN_DUP2, stdin, 0),
+        ])
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                # reaped elsewhere, e.g. SIGCHLD is ignored. Popen says 0 too.
+                self.returncode = 0
+            else:
+                if pid == self.pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
 
-        if locked:
-            sys.stdout.write('locked\n')
-            sys.stdout.flush()
-            while True:
-                time.sleep(1)  # just pause the process infinitely
+class _Worker(object):
+    """
+    The connection to a worker process which holds a file lock. The worker
+    is forked by `_LockDaemon`, or started by `Popen` if there is no daemon.
+    It owns the other end of the connection, so EOF means it has exited.
+    """
+
+    def __init__(self, wakeup_fd, lock_fd):
+        self._conn, peer = _socketpair()
+        self._proc = None
+        self.returncode = None
+        try:
+            daemon = _LockDaemon.get()
+            if daemon is not None:
+                daemon.spawn(peer.fileno(), wakeup_fd, lock_fd)
+            else:
+                fds = (peer.fileno(), wakeup_fd, lock_fd)
+                args = ([_PY_EXEC] + _PY_FLAGS + [_worker_script()] +
+                        [str(fd) for fd in fds])
+                if sys.version_info[0] >= 3:
+                    self._proc = Popen(args, pass_fds=fds)
+                else:
+                    self._proc = Popen(args)
+        except:
+            self._conn.close()
+            raise
+        finally:
+            peer.close()
+
+    def _close(self, returncode):
+        self.returncode = returncode
+        self._conn.close()
+        if self._proc is not None:
+            self._proc.wait()
+
+    def send(self, data):
+        self._conn.sendall(data)
+
+    def recv(self):
+        # one message on a SOCK_SEQPACKET connection
+        return self._conn.recv(64)
+
+    def poll(self):
+        if self.returncode is None:
+            # no select(), which cannot take fds over FD_SETSIZE
+            try:
+                data = self._conn.recv(1, socket.MSG_PEEK |
+                                       socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            else:
+                if not data:
+                    self._close(0)  # worker has closed the connection
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            while self._conn.recv(64):
+                pass  # until the worker exits
+            self._close(0)
+        return self.returncode
+
+    def kill(self):
+        if self._proc is not None:
+            self._proc.kill()
+        # the worker exits when the connection is closed
+        self._close(-signal.SIGKILL)
+
+def _socketpair():
+    # SOCK_SEQPACKET keeps message boundaries, but not every platform has it
+    try:
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    except (AttributeError, socket.error):
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+def _worker_script():
+    # returns the worker module compiled to bytecode, or its source
+    global _worker_script_path
+    if _worker_script_path is None:
+        _worker_script_path = _WORKER_PY
+        if sys.dont_write_bytecode:
+            return _worker_script_path
+        try:
+            import py_compile
+            from importlib.util import cache_from_source
+
+            cfile = cache_from_source(_WORKER_PY, optimization=2)
+            if not _pyc_is_current(cfile):
+                kwargs = {}
+                if sys.version_info >= (3, 7):
+                    # SOURCE_DATE_EPOCH would make hash based pyc the default
+                    kwargs['invalidation_mode'] = (
+                        py_compile.PycInvalidationMode.TIMESTAMP)
+                py_compile.compile(_WORKER_PY, cfile=cfile, doraise=True,
+                                   optimize=2, **kwargs)
+            _worker_script_path = cfile
+        except Exception:
+            pass  # run the source
+    return _worker_script_path
+
+def _pyc_is_current(cfile):
+    # a pyc run as a script is not checked against its source, so compare the
+    # source mtime and size in its header like the import system does
+    from importlib.util import MAGIC_NUMBER
+
+    stat = os.stat(_WORKER_PY)
+    header = MAGIC_NUMBER
+    if sys.version_info >= (3, 7):
+        header += struct.pack('<I', 0)  # flags of a timestamp based pyc
+    header += struct.pack('<II', int(stat.st_mtime) & 0xFFFFFFFF,
+                          stat.st_size & 0xFFFFFFFF)
+    try:
+        with open(cfile, 'rb') as pyc:
+            return pyc.read(len(header)) == header
+    except (IOError, OSError):
+        return False
+
+def _new_wakeup():
+    # returns the (read, write) fds used to wake up the worker
+    if _HAS_EVENTFD:
+        efd = os.eventfd(0, os.EFD_CLOEXEC)
+        return efd, efd
+    return os.pipe()
+
+def _close_wakeup(wakeup):
+    os.close(wakeup[0])
+    if wakeup[1] != wakeup[0]:
+        os.close(wakeup[1])
+
+def _pack_config(shared, timeout):
+    if timeout is None:
+        timeout = -1.0  # infinite
+    return struct.pack(_CONFIG_FORMAT, shared, timeout)